@@ -10,3 +10,7 @@ REPLACEMENT_POLICY = 'LRU'    # or 'MRU', etc.
 
 # Filenames or paths
 DATA_PATH = "./data"          # directory to store table files
+DATA_FILE = "data.{}.mpk"     # every table's frames, back to back, one file per manifest generation
+MANIFEST_FILE = "manifest.json"  # current DATA_FILE, table name -> metadata and (offset, length) into it
+RECORDS_PER_FRAME = 512       # records per length-prefixed frame of a table
+COMPRESSION_LEVEL = 3         # zstd level for each table's frames in DATA_FILE
@@ -1,10 +1,20 @@
+import gc
 import os
-import msgpack
-from lstore.table import Table, Record
+import fnmatch
+import hashlib
+import sys
+import mmap
+import struct
+import tempfile
+from array import array
+from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
+import zstandard as zstd
+from lstore.config import COMPRESSION_LEVEL, DATA_FILE, MANIFEST_FILE, RECORDS_PER_FRAME
+from lstore.table import Table
 from lstore.bufferpool import Bufferpool
-from lstore.index import Index
-from lstore.page import Page
-from lstore.query import Query
 
 class Database:
     def __init__(self, bufferpool_size=10):
@@ -19,26 +29,105 @@ class Database:
             return
 
         self.tables = {}
-        for file in os.listdir(path):
-            if file.endswith(".tbl"):
-                file_path = os.path.join(path, file)
-                with open(file_path, "rb") as f:
-                    data = f.read()
-                    if not data:
-                        continue
-                    table = msgpack.unpackb(data, raw=False, ext_hook=ext_hook, strict_map_key=False)
+        #decoding allocates a burst of lists and dicts that all outlive the
+        #load, so keep the cycle collector from repeatedly scanning them
+        with gc_paused():
+            manifest = read_manifest(path)
+            #files left by a close() that crashed before or after its commit point
+            remove_unreferenced(path, manifest)
+            if manifest.tables:
+                #one mapping of the data file, every table is a zstd-compressed slice of it
+                dctx = zstd.ZstdDecompressor()
+                tables = self.tables
+                #slices of the view are handed to zstd without copying, pages are
+                #faulted in as the decompressor reads them
+                with open(os.path.join(path, manifest.data_file), "rb") as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                        memoryview(mm) as view:
+                    for table_name, entry in manifest.tables.items():
+                        #streamed frames carry no content size, so decompress through a
+                        #decompressobj rather than the one-shot decompress()
+                        data = dctx.decompressobj().decompress(view[entry.offset:entry.offset + entry.length])
+                        table = read_table(path, data, entry.generation)
+                        if table is None:
+                            continue
 
-                    self.tables[table.name] = table
+                        tables[table.name] = table
 
     def close(self):
         if not self.db_path:
             raise ValueError("Database path is not set.")
         
-        for table_name, table in self.tables.items():
-            file_path = os.path.join(self.db_path, f"{table_name}.tbl")
-            with open(file_path, "wb") as f:
-                data = msgpack.packb(table, use_bin_type=True, default=custom_default)
-                f.write(data)
+        path = self.db_path
+        tables = self.tables
+        manifest = read_manifest(path)
+        on_disk = manifest.tables
+        #tables untouched since open() are not re-encoded, their bytes are
+        #carried over from the current data file
+        dirty = [(table_name, table) for table_name, table in tables.items()
+                 if table.dirty or table_name not in on_disk]
+        if not dirty and on_disk.keys() == tables.keys():
+            return
+
+        #nothing the current manifest points at is overwritten: the new data file
+        #and any rewritten column files carry the next generation in their name,
+        #and replacing the manifest is the single step that makes them live
+        generation = manifest.generation + 1
+
+        data_file = DATA_FILE.format(generation)
+        new_entries = {}
+        #encoding creates a burst of short-lived containers, collect once
+        #afterwards instead of letting gc fire in the middle of it
+        with gc_paused(), ThreadPoolExecutor() as pool, \
+                open(os.path.join(path, data_file), "wb") as out:
+            old = open(os.path.join(path, manifest.data_file), "rb") if on_disk else None
+            try:
+                #with several dirty tables each is flushed on the pool into its own
+                #spooled buffer, so one table's file writes and compression overlap
+                #with another's encoding; the buffers are appended in table order.
+                #a single dirty table streams straight into the data file
+                flushing = {}
+                if len(dirty) > 1:
+                    for table_name, table in dirty:
+                        flushing[table_name] = pool.submit(flush_spooled, path, table, on_disk.get(table_name), generation)
+                for table_name, table in tables.items():
+                    entry = on_disk.get(table_name)
+                    offset = out.tell()
+                    if table_name in flushing:
+                        spool, digest, columns_generation = flushing[table_name].result()
+                        with spool:
+                            length = spool.tell()
+                            spool.seek(0)
+                            copy_bytes(spool, out, length)
+                    elif table.dirty or entry is None:
+                        digest, columns_generation = flush_table(path, table, entry, generation, out)
+                    else:
+                        old.seek(entry.offset)
+                        copy_bytes(old, out, entry.length)
+                        digest, columns_generation = entry.digest, entry.generation
+                    new_entries[table_name] = ManifestEntry(
+                        num_columns=table.num_columns,
+                        key=table.key,
+                        next_rid=table.next_rid,
+                        offset=offset,
+                        length=out.tell() - offset,
+                        digest=digest,
+                        generation=columns_generation,
+                    )
+            finally:
+                if old is not None:
+                    old.close()
+            out.flush()
+            os.fsync(out.fileno())
+        gc.collect()
+        new_manifest = Manifest(generation=generation, data_file=data_file, tables=new_entries)
+        write_manifest(path, new_manifest)
+        #the previous data file and the column files of replaced or re-created
+        #tables are no longer referenced
+        remove_unreferenced(path, new_manifest)
+        #only now is every dirty table's state on disk
+        for _, table in dirty:
+            table.dirty = False
 
 
     """
@@ -49,6 +138,7 @@ class Database:
     """
     def create_table(self, name, num_columns, key_index):
         table = Table(name, num_columns, key_index) 
+        table.dirty = True  # never written to disk yet
         self.tables[name] = table
         return table
 
@@ -57,8 +147,14 @@ class Database:
     """
     def drop_table(self, name):
         if name in self.tables:
-            del self.tables[name]
-            os.remove(os.path.join(self.db_path, f"{name}.tbl"))
+            self.tables.pop(name)
+            #its frames stay in the data file until the next close() rewrites it,
+            #dropping the manifest entry is enough to make them unreachable
+            manifest = read_manifest(self.db_path)
+            entry = manifest.tables.pop(name, None)
+            if entry is not None:
+                write_manifest(self.db_path, manifest)
+                remove_unreferenced(self.db_path, manifest)
 
     """
     # Returns table with the passed name
@@ -66,85 +162,295 @@ class Database:
     def get_table(self, name):
         return self.tables.get(name, None)
 
+#Serialization Functions:
 
 
-#Serialization Functions:
+@contextmanager
+def gc_paused():
+    #disable the cycle collector for the block, restoring whatever state it was in
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
-# extension codes per object
-EXT_CODE_INDEX  = 1
-EXT_CODE_PAGE   = 2
-EXT_CODE_QUERY  = 3   
-EXT_CODE_RECORD = 4
-EXT_CODE_TABLE  = 5
-
-def custom_default(obj):
-
-    if isinstance(obj, Index):
-        # save index state
-        state = obj.__dict__
-        state = state.copy()
-        state.pop("table", None)
-        packed_state = msgpack.packb(state, use_bin_type=True)
-        return msgpack.ExtType(EXT_CODE_INDEX, packed_state)
-    
-    elif isinstance(obj, Page):
-        # only need to keep data
-        state = {"data": obj.data}
-        packed_state = msgpack.packb(state, use_bin_type=True)
-        return msgpack.ExtType(EXT_CODE_PAGE, packed_state)
-    
-    elif isinstance(obj, Query):
-        state = {"table_name": obj.table.name}
-        packed_state = msgpack.packb(state, use_bin_type=True)
-        return msgpack.ExtType(EXT_CODE_QUERY, packed_state)
-    
-    elif isinstance(obj, Record):
-        state = obj.__dict__
-        packed_state = msgpack.packb(state, use_bin_type=True)
-        return msgpack.ExtType(EXT_CODE_RECORD, packed_state)
-    
-    elif isinstance(obj, Table):
-        state = obj.__dict__.copy()
-        if "index" in state:
-            pass
-        packed_state = msgpack.packb(state, use_bin_type=True, default=custom_default)
-        return msgpack.ExtType(EXT_CODE_TABLE, packed_state)
-    
-    return None #if none of these (impossible in this case unless blank input)
-
-def ext_hook(code, data):
-    #use codes to figure out the object type, rehydrate based on each type
-    if code == EXT_CODE_INDEX:
-        state = msgpack.unpackb(data, raw=False, strict_map_key=False)
-        #rehydrate index, append state
-        index = Index(None)
-        index.__dict__.update(state)
-        return index
-
-    elif code == EXT_CODE_PAGE:
-        state = msgpack.unpackb(data, raw=False, strict_map_key=False)
-        page = Page()
-        page.data = state.get("data", bytearray())
-        return page
-
-    elif code == EXT_CODE_QUERY:
-        state = msgpack.unpackb(data, raw=False, strict_map_key=False)
-        #create dummy query with appropriate table name 
-        query = Query(Table(state.get("table_name", "unknown")))
-        return query
-
-    elif code == EXT_CODE_RECORD:
-        state = msgpack.unpackb(data, raw=False, strict_map_key=False)
-        record = Record(0, None, None) 
-        record.__dict__.update(state)
-        return record
-
-    elif code == EXT_CODE_TABLE:
-        state = msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=ext_hook)
-        table = Table(state["name"], state["num_columns"], state["key"])
-        table.__dict__.update(state)
-        return table
+# typed on-disk schema, encoded/decoded directly by msgspec's C msgpack codec
+# gc=False: state structs only hold plain ints/lists/dicts and never form cycles,
+# so there is no need for the cycle collector to track them.
+# array_like=True: fields are encoded positionally, so decoding a struct is a
+# fixed-order fill rather than a lookup of every field name
+class IndexState(msgspec.Struct, gc=False, array_like=True):
+    pk_keys: bytes          # sorted primary keys, little-endian int64
+    pk_rids: bytes          # rid of each key in pk_keys, little-endian int64
+    secondary_indexes: dict[int, dict[int, list[int]]]
+
+class TableState(msgspec.Struct, gc=False, array_like=True):
+    name: str
+    num_columns: int
+    key: int
+    next_rid: int
+    num_rows: int
+    page_directory: dict
+    index: IndexState
+
+# records are streamed after the table header in batches of RECORDS_PER_FRAME,
+# each field a little-endian int64 buffer that msgspec writes as a raw bin.
+# the column values themselves live in one {table}.{column}.col file per column,
+# a straight dump of Table.columns
+class RecordFrame(msgspec.Struct, gc=False, array_like=True):
+    rids: bytes             # rid of every record in the batch
+    version_counts: bytes   # number of versions kept for each record
+    rows: bytes             # column row of every version, version_counts[i] per record
+
+# where each table's frames sit in the data file, plus the digest of what was written.
+# the manifest is kept as indented json so the catalog can be read in an editor
+class ManifestEntry(msgspec.Struct, gc=False):
+    num_columns: int
+    key: int
+    next_rid: int
+    offset: int
+    length: int
+    digest: str
+    generation: int         # generation in the names of this table's column files
+
+class Manifest(msgspec.Struct, gc=False):
+    generation: int = 0     # bumped by every close() that writes a new data file
+    data_file: str = ""     # DATA_FILE of that generation, "" before the first close()
+    tables: dict[str, ManifestEntry] = {}
+
+# one encoder/decoder shared by every open()/close()
+TABLE_ENCODER = msgspec.msgpack.Encoder()
+TABLE_DECODER = msgspec.msgpack.Decoder(TableState)
+FRAME_DECODER = msgspec.msgpack.Decoder(RecordFrame)
+MANIFEST_ENCODER = msgspec.json.Encoder()
+MANIFEST_DECODER = msgspec.json.Decoder(Manifest)
+
+# every frame of a table is prefixed with its length as a 4-byte big-endian int
+FRAME_HEADER = struct.Struct(">I")
+COPY_CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 8 << 20 #bytes of a table's compressed frames kept in memory before spilling to disk
+
+def table_to_state(table):
+    index = table.index
+    pk_keys, pk_rids = index.sorted_pk()
+    return TableState(
+        name=table.name,
+        num_columns=table.num_columns,
+        key=table.key,
+        next_rid=table.next_rid,
+        num_rows=table.num_rows,
+        page_directory=table.page_directory,
+        index=IndexState(
+            pk_keys=to_int64_buffer(pk_keys),
+            pk_rids=to_int64_buffer(pk_rids),
+            secondary_indexes=index.secondary_indexes,
+        ),
+    )
+
+def state_to_table(state):
+    #rebuild a live table, then copy the persisted fields over
+    table = Table(state.name, state.num_columns, state.key)
+    table.next_rid = state.next_rid
+    table.num_rows = state.num_rows
+    table.page_directory = state.page_directory
+    table.index.load_pk(from_int64_bytes(state.index.pk_keys), from_int64_bytes(state.index.pk_rids))
+    table.index.secondary_indexes = state.index.secondary_indexes
+    return table
+
+def to_int64_buffer(values):
+    #an int64 array already in the on-disk layout is handed to the encoder as
+    #a view of its own memory instead of being copied out with tobytes().
+    #the array must not be resized while the view is alive, which holds since
+    #views only live for the encode that consumes them
+    if sys.byteorder == "little" and isinstance(values, array):
+        return memoryview(values)
+    arr = array("q", values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+def from_int64_bytes(data):
+    arr = array("q")
+    arr.frombytes(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+def column_path(path, table_name, column, generation):
+    return os.path.join(path, f"{table_name}.{column}.{generation}.col")
+
+def remove_unreferenced(path, manifest):
+    #deletes every data file and column file in path that manifest doesn't point at
+    referenced = {manifest.data_file}
+    for table_name, entry in manifest.tables.items():
+        referenced.update(os.path.basename(column_path(path, table_name, column, entry.generation))
+                          for column in range(entry.num_columns))
+    data_files = DATA_FILE.format("*")
+    for file_name in os.listdir(path):
+        if file_name not in referenced and (fnmatch.fnmatch(file_name, data_files) or file_name.endswith(".col")):
+            os.remove(os.path.join(path, file_name))
+
+def record_batches(table):
+    records = iter(table.rid_to_rows.items())
+    while True:
+        batch = list(islice(records, RECORDS_PER_FRAME))
+        if not batch:
+            return
+        yield batch
+
+def records_to_frame(batch):
+    rids = array("q")
+    version_counts = array("q")
+    rows = array("q")
+    for rid, version_rows in batch:
+        rids.append(rid)
+        version_counts.append(len(version_rows))
+        rows.extend(version_rows)
+    return RecordFrame(
+        rids=to_int64_buffer(rids),
+        version_counts=to_int64_buffer(version_counts),
+        rows=to_int64_buffer(rows),
+    )
+
+def frame_to_records(frame, rid_to_rows):
+    rows = from_int64_bytes(frame.rows).tolist()
+    pos = 0
+    for rid, count in zip(from_int64_bytes(frame.rids), from_int64_bytes(frame.version_counts)):
+        rid_to_rows[rid] = rows[pos:pos + count]
+        pos += count
+
+def write_columns(path, table, generation):
+    for column in range(table.num_columns):
+        write_column(column_path(path, table.name, column, generation), table.columns[column])
+
+def write_column(file_path, column):
+    with open(file_path, "wb") as f:
+        if sys.byteorder == "little":
+            column.tofile(f)
+        else:
+            f.write(to_int64_buffer(column))
+        #the manifest can only name this file once its contents are durable
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_column(file_path):
+    #columns are appended to after open(), so they are read into arrays rather
+    #than kept as views of the file
+    column = array("q")
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size % column.itemsize:
+            raise ValueError(f"{file_path} is {size} bytes, not a whole number of values")
+        column.fromfile(f, size // column.itemsize)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+def iter_frames(data):
+    #frames are yielded as views into data rather than sliced-out copies
+    data = memoryview(data)
+    pos = 0
+    while pos < len(data):
+        (length,) = FRAME_HEADER.unpack_from(data, pos)
+        pos += FRAME_HEADER.size
+        yield data[pos:pos + length]
+        pos += length
+
+def table_frames(table):
+    #header frame first, then the records one batch at a time
+    yield table_to_state(table)
+    for batch in record_batches(table):
+        yield records_to_frame(batch)
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return Manifest()
+    with open(manifest_path, "rb") as f:
+        return MANIFEST_DECODER.decode(f.read())
+
+def write_manifest(path, manifest):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "wb") as f:
+        f.write(msgspec.json.format(MANIFEST_ENCODER.encode(manifest), indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_path + ".tmp", manifest_path)
+    fsync_dir(path) #makes the rename itself durable
+
+def fsync_dir(path):
+    if os.name != "posix":
+        return #directories can't be opened for fsync elsewhere
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def encode_table(table, out):
+    #streams the table's length-prefixed frames into out as one zstd frame and
+    #returns the digest of the uncompressed table, so only one frame of it is
+    #ever held in memory
+    digest = hashlib.blake2b(digest_size=8)
+    #every frame is encoded in place after its length prefix in one reused
+    #buffer, so there are no per-frame bytes objects to allocate
+    buf = bytearray(FRAME_HEADER.size)
+    #threads=-1 hands compression to zstd's own worker threads, one per cpu,
+    #so it runs off this thread while the next frames are being encoded
+    cctx = zstd.ZstdCompressor(level=COMPRESSION_LEVEL, threads=-1)
+    with cctx.stream_writer(out, closefd=False) as writer:
+        for frame in table_frames(table):
+            TABLE_ENCODER.encode_into(frame, buf, FRAME_HEADER.size)
+            FRAME_HEADER.pack_into(buf, 0, len(buf) - FRAME_HEADER.size)
+            writer.write(buf)
+            digest.update(buf)
+    for column in table.columns:
+        digest.update(column)
+    return digest.hexdigest()
+
+def flush_table(path, table, entry, generation, out):
+    #encodes the table into out and writes its column files, returning the
+    #digest and the generation its column files are under
+    digest = encode_table(table, out)
+    #a table can be flagged dirty and still end up identical to what is on
+    #disk, it then keeps its existing column files
+    if entry is not None and entry.digest == digest:
+        return digest, entry.generation
+    write_columns(path, table, generation)
+    return digest, generation
+
+def flush_spooled(path, table, entry, generation):
+    #flush_table into a buffer that stays in memory up to SPOOL_SIZE and
+    #moves to a temporary file past it, so a large table isn't held whole
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        return (spool, *flush_table(path, table, entry, generation, spool))
+    except BaseException:
+        spool.close()
+        raise
 
+def copy_bytes(src, dst, length):
+    #carries a clean table's compressed bytes over a chunk at a time
+    while length:
+        chunk = src.read(min(length, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("data file is shorter than its manifest")
+        dst.write(chunk)
+        length -= len(chunk)
 
-    return None #if none of the codes match
+def read_table(path, data, generation):
+    frames = iter_frames(data)
+    header = next(frames, None)
+    if not header:
+        return None #empty entry
+    table = state_to_table(TABLE_DECODER.decode(header))
+    table.columns = [read_column(column_path(path, table.name, column, generation)) for column in range(table.num_columns)]
+    for column, values in enumerate(table.columns):
+        if len(values) != table.num_rows:
+            raise ValueError(f"column {column} of table {table.name} has {len(values)} rows, expected {table.num_rows}")
+    for frame in frames:
+        frame_to_records(FRAME_DECODER.decode(frame), table.rid_to_rows)
+    return table
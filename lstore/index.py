@@ -1,3 +1,6 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
 # # lstore/index.py
 
 # from collections import defaultdict
@@ -104,17 +107,82 @@
 class Index:
     def __init__(self, table):
         self.table = table
-        self.pk_index = {}  # Primary key index
+        # Primary key index: pk_index serves point lookups, pk_keys/pk_rids are a
+        # sorted copy of it for range queries that is brought up to date lazily
+        self.pk_index = {}  # pk -> rid
+        self.pk_keys = array('q')
+        self.pk_rids = array('q')  # pk_rids[i] is the rid of pk_keys[i]
+        self.pk_tail = []  # keys inserted since the sorted copy was last merged
+        self.pk_stale = False  # a key was removed since then, sorted copy must be rebuilt
         self.secondary_indexes = {}  # Maps column_id -> {value: [rids]}
 
+    def locate_pk(self, key):
+        """Returns the RID of the record with the given primary key, or None."""
+        return self.pk_index.get(key)
+
+    def locate_pk_range(self, begin, end):
+        """Returns the RIDs of all records with a primary key in [begin, end], in key order."""
+        keys, rids = self.sorted_pk()
+        lo = bisect_left(keys, begin)
+        hi = bisect_right(keys, end)
+        return rids[lo:hi]
+
+    def insert_pk(self, key, rid):
+        """Adds a primary key entry. Returns False if the key is already present."""
+        if key in self.pk_index:
+            return False
+        self.pk_index[key] = rid
+        self.pk_tail.append(key)
+        return True
+
+    def remove_pk(self, key):
+        """Removes a primary key entry. Returns its RID, or None if the key is absent."""
+        rid = self.pk_index.pop(key, None)
+        if rid is not None:
+            self.pk_stale = True
+        return rid
+
+    def sorted_pk(self):
+        """Returns the primary keys and their RIDs as two arrays sorted by key."""
+        if self.pk_stale:
+            keys = sorted(self.pk_index)
+        elif self.pk_tail:
+            self.pk_tail.sort()
+            if not self.pk_keys or self.pk_tail[0] > self.pk_keys[-1]:
+                # keys arrived in increasing order, the tail just extends the sorted run
+                self.pk_keys.extend(self.pk_tail)
+                self.pk_rids.extend(self.pk_index[key] for key in self.pk_tail)
+                self.pk_tail.clear()
+                return self.pk_keys, self.pk_rids
+            # two sorted runs, which sorted() merges in linear time
+            keys = sorted(self.pk_keys.tolist() + self.pk_tail)
+        else:
+            return self.pk_keys, self.pk_rids
+
+        self.pk_keys = array('q', keys)
+        self.pk_rids = array('q', [self.pk_index[key] for key in keys])
+        self.pk_tail.clear()
+        self.pk_stale = False
+        return self.pk_keys, self.pk_rids
+
+    def load_pk(self, keys, rids):
+        """Replaces the primary key index with the given sorted key/RID arrays."""
+        self.pk_index = dict(zip(keys, rids))
+        self.pk_keys = keys
+        self.pk_rids = rids
+        self.pk_tail = []
+        self.pk_stale = False
+
     def create_index(self, column_number):
         """Creates an index on a specific column."""
         if column_number == self.table.key_index:
             return
 
         self.secondary_indexes[column_number] = {}
-        for rid, versions in self.table.rid_to_versions.items():
-            latest_value = versions[-1][column_number]
+        self.table.dirty = True
+        column = self.table.columns[column_number]
+        for rid, rows in self.table.rid_to_rows.items():
+            latest_value = column[rows[-1]]
             if latest_value not in self.secondary_indexes[column_number]:
                 self.secondary_indexes[column_number][latest_value] = []
             self.secondary_indexes[column_number][latest_value].append(rid)
@@ -129,3 +197,4 @@ class Index:
         """Removes an index from a column."""
         if column_number in self.secondary_indexes:
             del self.secondary_indexes[column_number]
+            self.table.dirty = True
@@ -18,12 +18,16 @@ class Query:
     """
     def insert(self, *columns):
         pk_val = columns[self.table.key]
-        if pk_val in self.table.index.pk_index:
+        if self.table.index.locate_pk(pk_val) is not None:
             return False  # Primary key must be unique
 
+        try:
+            row = self.table.append_row(columns)
+        except (ValueError, TypeError, OverflowError):
+            return False  # wrong number of columns, or a value that isn't a 64-bit int
         new_rid = self.table.get_new_rid()
-        self.table.rid_to_versions[new_rid] = [list(columns)]
-        self.table.index.pk_index[pk_val] = new_rid
+        self.table.rid_to_rows[new_rid] = [row]
+        self.table.index.insert_pk(pk_val, new_rid)
         return True
 
     """
@@ -33,11 +37,12 @@ class Query:
     # Return False if record doesn't exist or is locked due to 2PL
     """
     def delete(self, primary_key):
-        rid = self.table.index.pk_index.pop(primary_key, None)
+        rid = self.table.index.remove_pk(primary_key)
         if rid is None:
             return False 
 
-        del self.table.rid_to_versions[rid] 
+        del self.table.rid_to_rows[rid] 
+        self.table.dirty = True
         return True
 
     """
@@ -52,26 +57,25 @@ class Query:
     def select(self, search_key, search_key_index, projected_columns_index):
         results = []
         if search_key_index == self.table.key:
-            rid = self.table.index.pk_index.get(search_key, None)
+            rid = self.table.index.locate_pk(search_key)
             if rid is None:
                 return []
-            versions = self.table.rid_to_versions[rid]
-            newest = versions[-1]
+            newest = self.table.rid_to_rows[rid][-1]
 
-            projected = [newest[i] for i, flag in enumerate(projected_columns_index) if flag == 1]
+            projected = [self.table.columns[i][newest] for i, flag in enumerate(projected_columns_index) if flag == 1]
             results.append(Record(rid, search_key, projected)) 
         else:
             rids = self.table.index.locate(search_key_index, search_key)
             if len(rids) == 0:
-                for rid, versions in self.table.rid_to_versions.items():
-                    if search_key == versions[-1][search_key_index]:
+                search_column = self.table.columns[search_key_index]
+                for rid, rows in self.table.rid_to_rows.items():
+                    if search_key == search_column[rows[-1]]:
                         rids.append(rid)
                 
             for rid in rids:
-                versions = self.table.rid_to_versions[rid]
-                newest = versions[-1]
+                newest = self.table.rid_to_rows[rid][-1]
 
-                projected = [newest[i] for i, flag in enumerate(projected_columns_index) if flag == 1]
+                projected = [self.table.columns[i][newest] for i, flag in enumerate(projected_columns_index) if flag == 1]
                 results.append(Record(rid, search_key, projected))
 
         return results
@@ -82,12 +86,12 @@ class Query:
     # Returns False if no records exist with given key or if the target record cannot be accessed due to 2PL locking
     """
     def update(self, primary_key, *columns):
-        rid = self.table.index.pk_index.get(primary_key, None)
+        rid = self.table.index.locate_pk(primary_key)
         if rid is None:
             return False  
 
-        versions = self.table.rid_to_versions[rid]
-        newest = versions[-1][:]  
+        rows = self.table.rid_to_rows[rid]
+        newest = self.table.read_row(rows[-1])  
 
         updated = False
         for col_idx, val in enumerate(columns):
@@ -96,7 +100,10 @@ class Query:
                 updated = True
 
         if updated:
-            versions.append(newest)
+            try:
+                rows.append(self.table.append_row(newest))
+            except (ValueError, TypeError, OverflowError):
+                return False  # the record is left as it was
 
         return True
 
@@ -109,11 +116,12 @@ class Query:
     # Returns False if no record exists in the given range
     """
     def sum(self, start_range, end_range, aggregate_column_index):
-        relevant_pks = [pk for pk in self.table.index.pk_index.keys() if start_range <= pk <= end_range]
-        if not relevant_pks:
+        relevant_rids = self.table.index.locate_pk_range(start_range, end_range)
+        if not relevant_rids:
             return 0
 
-        total = sum(self.table.rid_to_versions[self.table.index.pk_index[pk]][-1][aggregate_column_index] for pk in relevant_pks)
+        column = self.table.columns[aggregate_column_index]
+        total = sum(column[self.table.rid_to_rows[rid][-1]] for rid in relevant_rids)
         return total
     
     """
@@ -130,22 +138,22 @@ class Query:
         results = []
 
         if search_key_index == self.table.key:
-            rid = self.table.index.pk_index.get(search_key, None)
+            rid = self.table.index.locate_pk(search_key)
             if rid is None:
                 return []
-            versions = self.table.rid_to_versions[rid]
+            rows = self.table.rid_to_rows[rid]
 
-            idx = max(0, len(versions) - 1 + relative_version)
+            idx = max(0, len(rows) - 1 + relative_version)
 
-            projected = [versions[idx][i] for i, flag in enumerate(projected_columns_index) if flag == 1]
+            projected = [self.table.columns[i][rows[idx]] for i, flag in enumerate(projected_columns_index) if flag == 1]
             results.append(Record(rid, search_key, projected))  
         else:
             rids = self.table.index.locate(search_key_index, search_key)
             for rid in rids:
-                versions = self.table.rid_to_versions[rid]
-                idx = max(0, len(versions) - 1 + relative_version)
+                rows = self.table.rid_to_rows[rid]
+                idx = max(0, len(rows) - 1 + relative_version)
 
-                projected = [versions[idx][i] for i, flag in enumerate(projected_columns_index) if flag == 1]
+                projected = [self.table.columns[i][rows[idx]] for i, flag in enumerate(projected_columns_index) if flag == 1]
                 results.append(Record(rid, search_key, projected)) 
 
         return results
@@ -160,17 +168,17 @@ class Query:
     # Returns False if no record exists in the given range
     """
     def sum_version(self, start_range, end_range, aggregate_column_index, relative_version):
-        relevant_pks = [pk for pk in self.table.index.pk_index.keys() if start_range <= pk <= end_range]
-        if not relevant_pks:
+        relevant_rids = self.table.index.locate_pk_range(start_range, end_range)
+        if not relevant_rids:
             return 0
 
+        column = self.table.columns[aggregate_column_index]
         total = 0
-        for pk in relevant_pks:
-            rid = self.table.index.pk_index[pk]
-            versions = self.table.rid_to_versions[rid]
-            idx = max(0, len(versions) - 1 + relative_version)  
+        for rid in relevant_rids:
+            rows = self.table.rid_to_rows[rid]
+            idx = max(0, len(rows) - 1 + relative_version)  
 
-            total += versions[idx][aggregate_column_index]
+            total += column[rows[idx]]
 
         return total
 
@@ -1,4 +1,5 @@
 from lstore.index import Index
+from array import array
 import threading
 
 INDIRECTION_COLUMN = 0
@@ -21,21 +22,27 @@ class Table:
     :param num_columns: int     #Number of Columns: all columns are integer
     :param key: int             #Index of table key in columns
     """
+
+    # fixed attribute set: faster attribute access on the query paths and no per-table __dict__
+    __slots__ = ('name', 'num_columns', 'key', 'page_directory', 'columns', 'rid_to_rows', 'num_rows', 'index', 'next_rid', 'dirty')
+
     def __init__(self, name, num_columns, key):
         self.name = name
         self.num_columns = num_columns
         self.key = key
         self.page_directory = {}  
-        self.rid_to_versions = {}  
+        self.columns = [array('q') for _ in range(num_columns)]  # one int64 array per column
+        self.rid_to_rows = {}  # rid -> rows holding each version, oldest first
+        self.num_rows = 0  # rows appended to every column so far
         self.index = Index(self)  
         self.next_rid = 0  
+        self.dirty = False  # set by any change not yet written out by Database.close()
 
     def merge_base_tail(self):
-        for rid, versions in self.rid_to_versions.items():
-            if len(versions) > 1:
-                self.rid_to_versions[rid][0] = versions[-1]
-                versions.clear()
-                versions.append(self.rid_to_versions[rid][0])
+        for rid, rows in self.rid_to_rows.items():
+            if len(rows) > 1:
+                rows[:] = rows[-1:]
+                self.dirty = True
 
     def start_background_merge(self):
         merge_thread = threading.Thread(target=self.merge_base_tail)
@@ -46,13 +53,29 @@ class Table:
         self.next_rid += 1
         return rid
 
+    def append_row(self, values):
+        # validate length, types and range before touching any column, so a bad
+        # record can't leave the columns misaligned
+        if len(values) != self.num_columns:
+            raise ValueError(f"expected {self.num_columns} values, got {len(values)}")
+        values = array('q', values)
+        row = self.num_rows
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.num_rows += 1
+        self.dirty = True
+        return row
+
+    def read_row(self, row):
+        return [column[row] for column in self.columns]
+
     def insert_record(self, record):
         rid = self.get_new_rid()
-        self.rid_to_versions[rid] = [record]  
-        self.index.pk_index[record[self.key]] = rid 
+        self.rid_to_rows[rid] = [self.append_row(record)]  
+        self.index.insert_pk(record[self.key], rid) 
         return rid
 
     def get_latest_version(self, rid):
-        if rid in self.rid_to_versions:
-            return self.rid_to_versions[rid][-1]  
+        if rid in self.rid_to_rows:
+            return self.read_row(self.rid_to_rows[rid][-1])  
         return None
\ No newline at end of file